@@ -1,18 +1,43 @@
 import asyncio
-import random
+import os
 import struct
 import traceback
 import warnings
 from asyncio import Future, Lock, Task
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Optional, cast
+from typing import Optional
 
 import usb.backend
 import usb.core
 import usb.util
 
 
-@dataclass(kw_only=True)
+_STRUCT_BOOL = struct.Struct(">?")
+_STRUCT_BUTTON = struct.Struct(">5xB3xB")
+_STRUCT_H = struct.Struct(">H")
+_STRUCT_I = struct.Struct(">i")
+_STRUCT_EVENT = struct.Struct(">xxxBBBxxBxixxxxixxxxixxxxH?7xB19x")
+_STRUCT_LABEL_IDX = struct.Struct(">5xB")
+_STRUCT_OBJ = struct.Struct(">10x8sHHH14s4s4s4s12x")
+
+_PAYLOAD_PADDING = memoryview(bytes(58))
+
+_BOOL_PAYLOADS = (b"\x00\x00\x00\x00", b"\x00\x00\x00\x01")
+
+
+def _parse_hundredths(value: bytes, /):
+  # Parses decimal values such as b"2.10" into 210 without going through float
+  stripped = value.rstrip(b"\x00")
+  whole, sep, fraction = stripped.partition(b".")
+
+  if sep and (len(fraction) == 2) and whole.isdigit() and fraction.isdigit():
+    return int(whole) * 100 + int(fraction)
+
+  return round(float(stripped) * 100.0)
+
+
+@dataclass(kw_only=True, slots=True)
 class ButtonPressEvent:
   fnL: bool
   fnR: bool
@@ -23,7 +48,7 @@ class ButtonPressEvent:
   fn5: bool
   fn6: bool
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, slots=True)
 class StatusEvent:
   condenser: int
   """ The current condenser's index (0-6). """
@@ -62,7 +87,7 @@ class StatusEvent:
   def point(self):
     return (self.x, self.y, self.z)
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, slots=True)
 class ObjectiveInfo:
   magnification: int
   """ The magnification [0.1 X], for example `200` for 20X. """
@@ -89,61 +114,151 @@ class ObjectiveInfo:
   """ The working distance [0.01 mm], for example `210` for 2.10 mm. """
 
 
+def _parse_status_event(data, /):
+  objective, condenser, filter_shutter, optical_path, z, x, y, dia, light, zoom = _STRUCT_EVENT.unpack_from(data)
+
+  return StatusEvent(
+    condenser=(condenser - 1),
+    dia=(dia - 1) / 2099.0,
+    filter=((filter_shutter & 0x0f) - 1),
+    light=light,
+    objective=(objective - 1),
+    optical_path=(optical_path - 1),
+    shutter=(filter_shutter >= 0x10),
+    x=x,
+    y=y,
+    z=z,
+    zoom=(zoom - 0x40)
+  )
+
+
 class MicroscopeDevice:
   def __init__(self, device: usb.core.Device):
     self._device = device
     self._lock = Lock()
-    self._next_request_number = random.randrange(0xffff)
+    self._next_request_number = int.from_bytes(os.urandom(2), "big")
     self._requests = dict[int, Future[bytes]]()
+
+    # Writes are synchronous, so a single buffer can be shared by all requests.
+    self._tx_buffer = bytearray(62)
+    self._tx_buffer[58:60] = b"\x30\x31"
     self._receive_task: Optional[Task] = None
+    self._closed = False
+
+    # One worker for responses on 0x81 and one for events on 0x82, so that reads never wait behind each other or behind unrelated work on the default executor
+    self._response_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="nikon-usb-response")
+    self._event_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="nikon-usb-event")
+
+    self._label_cache = dict[tuple[bytes, int], tuple[str, str]]()
+    self._objective_cache = dict[int, ObjectiveInfo]()
 
   def __del__(self):
     if self._receive_task:
       self._receive_task.cancel()
 
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, exc_type, exc_value, exc_traceback):
+    self.close()
+
+  def close(self):
+    """
+    Stops the background tasks and threads used to communicate with the device.
+
+    The device cannot be used after being closed. This method is called automatically when leaving an `async with` block.
+    """
+
+    self._closed = True
+
+    if self._receive_task:
+      self._receive_task.cancel()
+
+    # Fail pending requests as their responses will no longer be read
+    for future in self._requests.values():
+      if not future.done():
+        future.set_exception(RuntimeError("Device is closed"))
+
+    self._requests.clear()
+
+    self._response_executor.shutdown(wait=False, cancel_futures=True)
+    self._event_executor.shutdown(wait=False, cancel_futures=True)
+
+  def _check_open(self):
+    if self._closed:
+      raise RuntimeError("Device is closed")
+
   async def _receive_loop(self):
-    loop = asyncio.get_event_loop()
+    loop = asyncio.get_running_loop()
 
     try:
       while self._requests:
-        response = cast(bytes, (await loop.run_in_executor(None, lambda: self._device.read(0x81, 62, 10000))).tobytes())
-        response_number, = struct.unpack(">H", response[60:])
+        response: bytes = (await loop.run_in_executor(self._response_executor, lambda: self._device.read(0x81, 62, 10000))).tobytes()
+        response_number, = _STRUCT_H.unpack_from(response, 60)
 
-        future = self._requests.get(response_number)
+        future = self._requests.pop(response_number, None)
 
         if future:
-          future.set_result(response)
-          del self._requests[response_number]
+          if not future.done():
+            future.set_result(response)
         else:
           warnings.warn(f"Leaked request with number '{response_number}'")
     except asyncio.CancelledError:
       pass
-    except Exception:
+    except Exception as e:
       traceback.print_exc()
+
+      # Fail pending requests instead of leaving them waiting for a response that will never be read
+      for future in self._requests.values():
+        if not future.done():
+          future.set_exception(e)
+
+      self._requests.clear()
     finally:
       self._receive_task = None
 
   async def _request(self, payload: bytes, /):
+    self._check_open()
+
     request_number = self._next_request_number
-    self._next_request_number = (self._next_request_number + 1) % 0xffff
-    # print("WRITE", "".join([f"{a:02x}" for a in list(payload.ljust(58, b"\x00") + b"\x30\x31" + struct.pack(">H", request_number))]))
+    self._next_request_number = (self._next_request_number + 1) & 0xffff
 
-    future = Future[bytes]()
+    future: Future[bytes] = asyncio.get_running_loop().create_future()
     self._requests[request_number] = future
 
     if not self._receive_task:
       self._receive_task = asyncio.create_task(self._receive_loop())
 
-    self._device.write(0x01, payload.ljust(58, b"\x00") + b"\x30\x31" + struct.pack(">H", request_number))
+    payload_length = len(payload)
+    self._tx_buffer[:payload_length] = payload
+    self._tx_buffer[payload_length:58] = _PAYLOAD_PADDING[payload_length:]
+    _STRUCT_H.pack_into(self._tx_buffer, 60, request_number)
+    # print("WRITE", self._tx_buffer.hex())
+
+    self._device.write(0x01, self._tx_buffer)
 
     try:
       return await asyncio.wait_for(asyncio.shield(future), 15e3)
     except (asyncio.CancelledError, asyncio.TimeoutError):
-      del self._requests[request_number]
+      self._requests.pop(request_number, None)
       raise
 
   async def _call(self, call_type: int, payload: bytes, /):
-    return await self._request(b"\x01\x00\x21\xff\x00\x00" + bytes([call_type]) + payload.rjust(4, b"\x00"))
+    # The payload must be exactly 4 bytes long
+    return await self._request(b"\x01\x00\x21\xff\x00\x00" + bytes([call_type]) + payload)
+
+
+  # Metadata
+
+  def invalidate_metadata(self):
+    """
+    Clears the cached labels and objective information.
+
+    Labels and objective information are queried once and then cached for the lifetime of the device. This method should be called after changing the hardware installed on the microscope.
+    """
+
+    self._label_cache.clear()
+    self._objective_cache.clear()
 
 
   # Version numbers
@@ -151,80 +266,89 @@ class MicroscopeDevice:
   async def get_firmware_cpu_version(self):
     flag = False
 
-    async with self._lock:
-      res = await self._request(b"\x01\x00\x08\x00\x00\x00\x00\x00\x00" + struct.pack(">?", flag))
-      return res[6:11].decode("ascii")
+    res = await self._request(b"\x01\x00\x08\x00\x00\x00\x00\x00\x00" + _STRUCT_BOOL.pack(flag))
+    return res[6:11].decode("ascii")
 
   async def get_version(self):
-    async with self._lock:
-      res = await self._request(b"\x01\x00\xe8\x30")
-      return res[6:14].decode("ascii")
+    res = await self._request(b"\x01\x00\xe8\x30")
+    return res[6:14].decode("ascii")
 
 
   # Labels
 
   async def _get_label(self, header: bytes, index: int):
-    async with self._lock:
-      res = await self._request(header + struct.pack(">5xB", index + 1))
-      return (
-        res[10:40].decode("ascii").rstrip(" "),
-        res[40:50].decode("ascii").rstrip(" ")
-      )
+    key = (header, index)
+
+    if key in self._label_cache:
+      return self._label_cache[key]
+
+    res = await self._request(header + _STRUCT_LABEL_IDX.pack(index + 1))
+    label = (
+      res[10:40].rstrip(b" ").decode("ascii"),
+      res[40:50].rstrip(b" ").decode("ascii")
+    )
+
+    self._label_cache[key] = label
+    return label
 
   async def get_condenser_label(self, index: int, /):
     return (await self._get_label(b"\x01\x00\x19\x04", index))[0]
 
   async def get_condenser_labels(self):
-    return [await self.get_condenser_label(index) for index in range(7)]
+    return await asyncio.gather(*(self.get_condenser_label(index) for index in range(7)))
 
   async def get_filter_label(self, index: int, /):
     return (await self._get_label(b"\x01\x00\x19\x08", index))[0]
 
   async def get_filter_labels(self):
-    return [await self.get_filter_label(index) for index in range(6)]
+    return await asyncio.gather(*(self.get_filter_label(index) for index in range(6)))
 
   async def get_optical_path_label(self, index: int, /):
     return (await self._get_label(b"\x01\x00\x19\x18", index))[1]
 
   async def get_optical_path_labels(self):
-    return [await self.get_optical_path_label(index) for index in range(4)]
+    return await asyncio.gather(*(self.get_optical_path_label(index) for index in range(4)))
 
   async def get_zoom_label(self, index: int, /):
     return (await self._get_label(b"\x01\x00\x19\x2c", index))[1]
 
   async def get_zoom_labels(self):
-    return [await self.get_zoom_label(index) for index in range(2)]
+    return await asyncio.gather(*(self.get_zoom_label(index) for index in range(2)))
 
 
   # Objectives
 
   async def get_objective_info(self, index: int, /):
-    async with self._lock:
-      res = await self._request(b"\x01\x00\x19\x00" + struct.pack(">5xB", index + 1))
-      model, magnification, numerical_aperture, pfs, \
-        series, working_distance, observation, refractive_index = struct.unpack(">10x8sHHH14s4s4s4s12x", res)
-
-      return ObjectiveInfo(
-        magnification=magnification,
-        numerical_aperture=numerical_aperture,
-        model=model.decode("ascii"),
-        observation=observation.decode("ascii").rstrip("\x00"),
-        pfs=(pfs == 2),
-        refractive_index=refractive_index.decode("ascii").rstrip("\x00"),
-        series=series.decode("ascii").rstrip("\x00"),
-        working_distance=round(float(working_distance) * 100.0),
-      )
+    if index in self._objective_cache:
+      return self._objective_cache[index]
+
+    res = await self._request(b"\x01\x00\x19\x00" + _STRUCT_LABEL_IDX.pack(index + 1))
+    model, magnification, numerical_aperture, pfs, \
+      series, working_distance, observation, refractive_index = _STRUCT_OBJ.unpack_from(res)
+
+    info = ObjectiveInfo(
+      magnification=magnification,
+      numerical_aperture=numerical_aperture,
+      model=model.rstrip(b"\x00").decode("ascii"),
+      observation=observation.rstrip(b"\x00").decode("ascii"),
+      pfs=(pfs == 2),
+      refractive_index=refractive_index.rstrip(b"\x00").decode("ascii"),
+      series=series.rstrip(b"\x00").decode("ascii"),
+      working_distance=_parse_hundredths(working_distance),
+    )
+
+    self._objective_cache[index] = info
+    return info
 
   async def get_objective_infos(self):
-    return [await self.get_objective_info(index) for index in range(6)]
+    return await asyncio.gather(*(self.get_objective_info(index) for index in range(6)))
 
 
   # Stage bounds
 
   async def _get_bound(self, header: bytes):
     res = await self._request(b"\x01\x00" + header)
-    bound, = cast(tuple[int], struct.unpack(">i", res[6:10]))
-    return bound
+    return _STRUCT_I.unpack_from(res, 6)[0]
 
   async def get_x_bounds(self):
     """
@@ -265,40 +389,49 @@ class MicroscopeDevice:
 
   # Events
 
-  async def get_event(self):
+  async def _read_event(self):
+    self._check_open()
+
     loop = asyncio.get_running_loop()
-    data = await loop.run_in_executor(None, lambda: self._device.read(0x82, 64, 15000))
-    unpacked = struct.unpack(">xxxBBBxxBxixxxxixxxxixxxxH?7xB19x", data)
-
-    return StatusEvent(
-      condenser=(unpacked[1] - 1),
-      dia=(unpacked[7] - 1) / 2099.0,
-      filter=((unpacked[2] & 0x0f) - 1),
-      light=unpacked[8],
-      objective=(unpacked[0] - 1),
-      optical_path=(unpacked[3] - 1),
-      shutter=(unpacked[2] >= 0x10),
-      x=unpacked[5],
-      y=unpacked[6],
-      z=unpacked[4],
-      zoom=(unpacked[9] - 0x40)
-    )
+    return await loop.run_in_executor(self._event_executor, lambda: self._device.read(0x82, 64, 15000))
 
-  async def get_status(self):
-    async for event in self:
-      if isinstance(event, StatusEvent):
-        return event
+  async def get_event(self):
+    return _parse_status_event(await self._read_event())
 
-    raise Exception()
+  async def get_status(self):
+    # Only status events are currently reported on the event endpoint
+    return await self.get_event()
 
   async def get_stable_status(self, *, idle_duration: float = 0.5):
+    loop = asyncio.get_running_loop()
+    stable_future: Future[StatusEvent] = loop.create_future()
+
+    # The timer carries the status it was scheduled for, so that a newer status read in the same loop iteration cannot replace it
     status = await self.get_status()
+    timer = loop.call_later(idle_duration, stable_future.set_result, status)
+
+    async def watch():
+      nonlocal timer
+
+      while not stable_future.done():
+        status = await self.get_status()
+
+        if not stable_future.done():
+          timer.cancel()
+          timer = loop.call_later(idle_duration, stable_future.set_result, status)
 
-    while True:
-      try:
-        status = await asyncio.wait_for(self.get_status(), timeout=idle_duration)
-      except TimeoutError:
-        return status
+    def forward_exception(task: Task):
+      if (not task.cancelled()) and task.exception() and (not stable_future.done()):
+        stable_future.set_exception(task.exception()) # type: ignore
+
+    watch_task = asyncio.create_task(watch())
+    watch_task.add_done_callback(forward_exception)
+
+    try:
+      return await stable_future
+    finally:
+      timer.cancel()
+      watch_task.cancel()
 
 
   # Iterator methods
@@ -321,7 +454,7 @@ class MicroscopeDevice:
     """
 
     async with self._lock:
-      await self._call(0xa8, struct.pack(">i", value))
+      await self._call(0xa8, _STRUCT_I.pack(value))
 
   async def set_y(self, value: int, /):
     """
@@ -332,7 +465,7 @@ class MicroscopeDevice:
     """
 
     async with self._lock:
-      await self._call(0xac, struct.pack(">i", value))
+      await self._call(0xac, _STRUCT_I.pack(value))
 
   async def set_z(self, value: int, /):
     """
@@ -343,7 +476,30 @@ class MicroscopeDevice:
     """
 
     async with self._lock:
-      await self._call(0xa0, struct.pack(">i", value))
+      await self._call(0xa0, _STRUCT_I.pack(value))
+
+  async def set_xy(self, x: int, y: int, /):
+    """
+    Moves the stage to a given x and y position.
+
+    Both commands are sent before waiting for either response, so the move should take about one round trip instead of the two taken by `set_x()` followed by `set_y()`. Sending both commands at once has not yet been tested on a microscope.
+
+    Args:
+      x: The x position [0.1 µm].
+      y: The y position [0.1 µm].
+    """
+
+    async with self._lock:
+      # Wait for both commands before releasing the lock, even if one of them fails
+      results = await asyncio.gather(
+        self._call(0xa8, _STRUCT_I.pack(x)),
+        self._call(0xac, _STRUCT_I.pack(y)),
+        return_exceptions=True
+      )
+
+      for result in results:
+        if isinstance(result, BaseException):
+          raise result
 
   # async def set_z_accuracy(self, value: int, /):
   #   assert 0 <= value <= 9
@@ -365,7 +521,7 @@ class MicroscopeDevice:
     assert 0 <= value < 7
 
     async with self._lock:
-      await self._call(0x88, struct.pack(">H", value + 1))
+      await self._call(0x88, (value + 1).to_bytes(4, "big"))
 
   # [100 %]
   async def set_dia(self, value: float, /):
@@ -378,7 +534,7 @@ class MicroscopeDevice:
     assert 0.0 <= value <= 1.0
 
     async with self._lock:
-      await self._call(0xb5, struct.pack(">H", round(value * 2099.0 + 1.0)))
+      await self._call(0xb5, round(value * 2099.0 + 1.0).to_bytes(4, "big"))
 
   async def set_filter(self, value: int, /):
     """
@@ -391,7 +547,7 @@ class MicroscopeDevice:
     assert 0 <= value < 6
 
     async with self._lock:
-      await self._call(0x8c, struct.pack(">H", value + 1))
+      await self._call(0x8c, (value + 1).to_bytes(4, "big"))
 
   async def set_light(self, value: bool, /):
     """
@@ -401,7 +557,7 @@ class MicroscopeDevice:
       value: Whether to enable the light.
     """
     async with self._lock:
-      await self._call(0xb4, struct.pack(">x?", value))
+      await self._call(0xb4, _BOOL_PAYLOADS[bool(value)])
 
   async def set_objective(self, value: int, /):
     """
@@ -413,7 +569,7 @@ class MicroscopeDevice:
     assert 0 <= value < 6
 
     async with self._lock:
-      await self._call(0x80, struct.pack(">B", value + 1))
+      await self._call(0x80, (value + 1).to_bytes(4, "big"))
 
   async def set_optical_path(self, value: int, /):
     """
@@ -426,7 +582,7 @@ class MicroscopeDevice:
     assert 0 <= value < 4
 
     async with self._lock:
-      await self._call(0x98, struct.pack(">B", value + 1))
+      await self._call(0x98, (value + 1).to_bytes(4, "big"))
 
   async def set_shutter(self, value: bool, /):
     """
@@ -437,7 +593,7 @@ class MicroscopeDevice:
     """
 
     async with self._lock:
-      await self._call(0x8d, struct.pack(">?", value))
+      await self._call(0x8d, _BOOL_PAYLOADS[bool(value)])
 
 
   # Buttons
@@ -446,7 +602,7 @@ class MicroscopeDevice:
     assert 0 <= index < 8
 
     async with self._lock:
-      await self._request(b"\x01\x00\x03\x28" + struct.pack(">5xB3xB", index, function))
+      await self._request(b"\x01\x00\x03\x28" + _STRUCT_BUTTON.pack(index, function))
 
   # async def set_button_notifications(self, e: ButtonPressEvent):
   #   async with self._lock: